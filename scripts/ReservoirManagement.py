@@ -207,23 +207,43 @@ Vmin Vmax Vinit
 
 # + [markdown] tags=[] slideshow={"slide_type": "subslide"}
 # ## Load data
+#
+# The tables are small, so they are read with the standard library `csv` module rather than pandas.
 
 # + tags=[]
+import csv
 import itertools as it
+import os
+import sys
+from types import SimpleNamespace
 
 import numpy as np
-import pandas as pd
 
 import dimod
-from dimod import quicksum as Sum
 from dwave import system as dw
-# -
 
-pumps = pd.read_csv("pumps.csv", sep=' ').set_index('id', drop=False)
-exogenous = pd.read_csv("exogenous.csv", sep=' ').set_index('time', drop=False)
-tariff = pd.read_csv("tariff.csv", sep=' ')
-reservoir = pd.read_csv("reservoir.csv", sep=' ').loc[0]
 
+# +
+def number(text):
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+def read_table(filename):
+    with open(filename, newline='') as f:
+        return [
+            {column: number(value) for column, value in row.items()}
+            for row in csv.DictReader(f, delimiter=' ')
+        ]
+
+
+# -
+
+pumps = read_table("pumps.csv")
+exogenous = read_table("exogenous.csv")
+tariff = read_table("tariff.csv")
+reservoir = SimpleNamespace(**read_table("reservoir.csv")[0])
 
 # + [markdown] tags=[] slideshow={"slide_type": "slide"}
 # ## Define domain language
@@ -242,24 +262,37 @@ reservoir = pd.read_csv("reservoir.csv", sep=' ').loc[0]
 #
 # > **The capacities and values of the electric power of the pumps are presented in Table 1**
 
+pump_ids = tuple(row['id'] for row in pumps)
+
 # ##### Pump capacity
 
+# +
+capacities = {row['id']: row['capacity'] for row in pumps}
+pump_capacities = np.array([capacities[pump] for pump in pump_ids])
+
 def capacity(pump):
-    return pumps.capacity[pump]
+    return capacities[pump]
 
 
+# -
+
 # ##### Pump power consumption
 
+# +
+power_consumptions = {row['id']: row['power_consumption'] for row in pumps}
+pump_power_consumptions = np.array([power_consumptions[pump] for pump in pump_ids])
+
 def power_consumption(pump):
-    return pumps.power_consumption[pump]
+    return power_consumptions[pump]
 
 
+# -
+
 # #### Timeslots
 #
 # > **a basically continuous process of water distribution is approximately described in a discrete form, namely by specifying 24 predicted values of the demand for 24 one-hour timeslots**
 
-timeslots = exogenous.time
-
+timeslots = tuple(row['time'] for row in exogenous)
 
 # #### Power prices
 #
@@ -271,8 +304,11 @@ timeslots = exogenous.time
 #
 # The provided power needs to be divide by 1000 since the pump power consumption is gien in kWh.
 
+# +
+power_prices = {row['time']: row['power_price']/1000 for row in exogenous}
+
 def power_price(time):
-    return exogenous.power_price[time]/1000
+    return power_prices[time]
 
 
 # + [markdown] tags=[]
@@ -283,10 +319,12 @@ def power_price(time):
 # > **The demand for water varies over time**
 #
 # > **So, the example numerical data of the demand values for 24 timeslots of just one specific day are presented in Table 3 (along with corresponding electric power prices)**
-# -
+
+# +
+water_demands = {row['time']: row['water_demand'] for row in exogenous}
 
 def water_demand(time):
-    return exogenous.water_demand[time]
+    return water_demands[time]
 
 
 # + [markdown] slideshow={"slide_type": "subslide"}
@@ -303,9 +341,27 @@ def water_demand(time):
 # > **The pumps can operate with their nominal capacities only, and the amount of water pumped by any pump depends on the time of operation only**
 #
 # > **In each timeslot, each pump can either be used or not**
+#
+# All pump-time combinations are enumerated once, timeslot by timeslot, and their variable labels are formatted up front and shared by every term that refers to the schedule. The labels of each timeslot are also kept in `pump_ids` order, to line up with the pump parameter arrays. The variables themselves are declared in the model up front, one binary per label.
 
-def is_running(pump, time):
-    return dimod.Binary(f"pump{pump}_time{time}")
+# +
+pump_times = tuple((pump, time) for time, pump in it.product(timeslots, pump_ids))
+
+running_labels = {
+    (pump, time): sys.intern(f"pump{pump}_time{time}")
+    for pump, time in pump_times
+}
+
+timeslot_labels = {
+    time: tuple(running_labels[pump, time] for pump in pump_ids)
+    for time in timeslots
+}
+
+def running_label(pump, time):
+    return running_labels[pump, time]
+
+def add_schedule_variables(model):
+    model.add_variables('BINARY', running_labels.values())
 
 
 # + [markdown] slideshow={"slide_type": "subslide"}
@@ -314,6 +370,12 @@ def is_running(pump, time):
 # Derived terms expressing interactions between inputs and outputs.
 # -
 
+# Most terms are weighted sums of the pump schedule with known coefficients. These are built directly from a `{label: coefficient}` mapping (or `(label, coefficient)` pairs), which avoids merging one single-variable model per pump. The coefficients of a timeslot are the pump parameter arrays, zipped with the timeslot's labels.
+
+def linear_bqm(coefficients):
+    return dimod.BinaryQuadraticModel(coefficients, {}, 0, 'BINARY')
+
+
 # #### Reservoir inflow
 #
 # The amount of water flowing into the reservoir is the sum of the capacities of the currently running pumps.
@@ -321,10 +383,7 @@ def is_running(pump, time):
 # > **Water is pumped from the wells to a single reservoir tank**
 
 def reservoir_inflow(time):
-    return Sum(
-            capacity(pump) * is_running(pump, time)
-            for pump in pumps.id
-        )
+    return linear_bqm(zip(timeslot_labels[time], pump_capacities.tolist()))
 
 
 # #### Resrvoir outflow
@@ -334,26 +393,37 @@ def reservoir_inflow(time):
 
 reservoir_outflow = water_demand
 
-
 # #### Resevoir volume
 #
 # Water pumped in excess of demand is retained in the reservoir to satisfy future demand.
 #
 # > **[The objective] is achieved thanks to the variability of both the demand for water and the price of electric power during the day combined with the possibility of storing water.**
+#
+# The volume is not a separate continuous variable: it is the initial volume plus the accumulated inflow less the accumulated outflow, a linear expression in the pump schedule. Both running totals are computed once for all timeslots, so each timeslot's inflow is added to the total only once.
+
+# +
+cumulative_inflow = dict(zip(
+    timeslots,
+    it.accumulate(reservoir_inflow(time) for time in timeslots),
+))
 
-def reservoir_volume(time): 
-    return reservoir.Vinit + Sum(map(reservoir_inflow, range(1,time+1))) - Sum(map(reservoir_outflow, range(1,time+1)))
+cumulative_outflow = dict(zip(
+    timeslots,
+    np.cumsum([reservoir_outflow(time) for time in timeslots]).tolist(),
+))
 
+def reservoir_volume(time):
+    return reservoir.Vinit + cumulative_inflow[time] - cumulative_outflow[time]
+
+
+# -
 
 # #### Combined power consumption
 #
 # The power consumed by the pumps running at a given time.
 
 def power_used(time):
-    return Sum(
-            power_consumption(pump) * is_running(pump, time)
-            for pump in pumps.id
-        )
+    return linear_bqm(zip(timeslot_labels[time], pump_power_consumptions.tolist()))
 
 
 # + [markdown] slideshow={"slide_type": "slide"}
@@ -361,25 +431,31 @@ def power_used(time):
 # -
 
 # With a well designed domain interface the objective and constraints should reflect statements in the problem specification.
+#
+# Each part of the model is written as a function, so that the complete model can be built in one step.
+#
+# The constraints are generated as the arguments of `model.add_constraint`. Plain sums over the pump schedule are given as `(terms, sense, rhs, label)` tuples, where the terms are `(variable, coefficient)` pairs, and are added to the model one at a time with `add_constraint_from_iterable`. This skips building an intermediate model for every constraint, but requires the variables to be declared in the model up front. Constraints on derived terms are given as a `(comparison, label)` pair, so that they read like the problem specification.
 
-# + [markdown] slideshow={"slide_type": "subslide"}
-# ### Initialize model
-# -
+def add_constraints(model, constraints):
+    for constraint in constraints:
+        model.add_constraint(*constraint)
 
-model = dimod.CQM()
 
 # + [markdown] slideshow={"slide_type": "subslide"}
 # ### Define objective
 # -
 
 # #### *The objective of the article is the minimization of the cost of electric power used by the pumps supplying water*
+#
+# The cost in each timeslot is the power price times the power used. The running cost of every pump in every timeslot is collected into a single `{label: cost}` mapping, so the objective is built as one linear model rather than by summing a model per timeslot.
+
+def set_objective(model):
+    running_costs = {}
+    for time in timeslots:
+        running_costs.update((power_price(time) * power_used(time)).linear)
+
+    model.set_objective(linear_bqm(running_costs))
 
-model.set_objective(
-    Sum(
-        power_price(time) * power_used(time)
-        for time in timeslots
-    )
-)
 
 # + [markdown] tags=[] slideshow={"slide_type": "subslide"}
 # ### Add constraints
@@ -388,23 +464,34 @@ model.set_objective(
 # #### *Each pump must operate for at least one hour per day*
 # -
 
-for pump in pumps.id:
-    model.add_constraint(
-        Sum(
-            is_running(pump, time) for time in timeslots
-        ) >= 1,
-        f"pump{pump}_on_at_least_1h_per_day")
+def pump_constraints():
+    for pump in pump_ids:
+        yield (
+            [(running_label(pump, time), 1) for time in timeslots], '>=', 1,
+            f"pump{pump}_on_at_least_1h_per_day")
+
 
 # + [markdown] slideshow={"slide_type": "subslide"}
-# #### *At least one well and the pump integrated with it must be kept as a reserve at any moment of the day*
+# #### Interchangeable pumps
+#
+# Pumps with the same capacity and power consumption are interchangeable: swapping their schedules gives a different solution with the same cost. Requiring the pump with the lower id to run at least as many hours as the other keeps only one of each such pair of solutions, which shrinks the space the solver has to search.
+#
+# None of the pumps in Table 1 are identical, so no constraints are added for this data.
 # -
 
-for time in timeslots:
-    model.add_constraint(
-        Sum(
-            is_running(pump, time) for pump in pumps.id
-        ) <= pumps.shape[0] - 1,
-        f"at_least_one_pump_in_reserve_at_time{time}" )
+def interchangeable_pump_constraints():
+    pumps_by_type = {}
+    for pump in pump_ids:
+        pumps_by_type.setdefault((capacity(pump), power_consumption(pump)), []).append(pump)
+
+    for group in pumps_by_type.values():
+        for pump, other in zip(group, group[1:]):
+            yield (
+                [(running_label(pump, time), 1) for time in timeslots]
+                + [(running_label(other, time), -1) for time in timeslots],
+                '>=', 0,
+                f"pump{pump}_runs_at_least_as_long_as_pump{other}")
+
 
 # + [markdown] slideshow={"slide_type": "subslide"}
 # #### *The water inside the tank should be replaced at least once per day (?)*
@@ -420,40 +507,153 @@ for time in timeslots:
 #     )
 
 # + [markdown] slideshow={"slide_type": "subslide"}
-# #### *... a single reservoir tank with the capacity of Vmax*
-# -
+# #### Constraints at each timeslot
+#
+# The remaining requirements are stated per timeslot, so they are added in a single pass over the timeslots. The reservoir bounds are stated directly on the reservoir volume:
+#
+# - *At least one well and the pump integrated with it must be kept as a reserve at any moment of the day*
+# - *... a single reservoir tank with the capacity of Vmax*
+# - *The volume of water in the reservoir tank cannot be less than Vmin*
+#
+# A reservoir bound is only added if the volume can actually reach it. The volume is lowest when no pump has run yet, which is its constant `offset`, and highest when the largest allowed set of pumps has run in every elapsed timeslot.
+
+# +
+max_running_pumps = len(pump_ids) - 1
+
+max_inflow_per_timeslot = sum(sorted(pump_capacities.tolist(), reverse=True)[:max_running_pumps])
+max_cumulative_inflow = {
+    time: (position + 1) * max_inflow_per_timeslot
+    for position, time in enumerate(timeslots)
+}
+
+
+def timeslot_constraints():
+    for time in timeslots:
+        yield (
+            [(label, 1) for label in timeslot_labels[time]], '<=', max_running_pumps,
+            f"at_least_one_pump_in_reserve_at_time{time}")
+
+        volume = reservoir_volume(time)
+        if volume.offset + max_cumulative_inflow[time] > reservoir.Vmax:
+            yield volume <= reservoir.Vmax, f"within_capacity_at_time{time}"
+        if volume.offset < reservoir.Vmin:
+            yield volume >= reservoir.Vmin, f"sufficient_reserve_at_time{time}"
 
-for time in timeslots:
-    model.add_constraint(
-        reservoir_volume(time) <= reservoir.Vmax,
-        f"within_capacity_at_time{time}"
-    )
 
 # + [markdown] slideshow={"slide_type": "subslide"}
-# #### *The volume of water in the reservoir tank cannot be less than Vmin*
+# ### Build model
 # -
 
-for time in timeslots:
-    model.add_constraint(
-        reservoir_volume(time) >= reservoir.Vmin,
-        f"sufficient_reserve_at_time{time}"
-    )
+def build_model():
+    model = dimod.CQM()
+    add_schedule_variables(model)
+    set_objective(model)
+    add_constraints(model, it.chain(
+        pump_constraints(),
+        interchangeable_pump_constraints(),
+        timeslot_constraints(),
+    ))
+    return model
+
+
+model = build_model()
+
 
 # + [markdown] tags=[] slideshow={"slide_type": "slide"}
 # ## Solve Model
 # -
 
+# ### Greedy baseline
+#
+# A cheap classical schedule gives a reference cost for the solver's result. Each hour the pumps with the lowest power consumption per unit of water are switched on until the volume is back above Vmin. Pumps that never ran are then added in the cheapest hour where they fit under Vmax.
+#
+# The Leap hybrid CQM sampler does not take initial states, so the schedule is only used for comparison and not as a warm start.
+
+# +
+def greedy_schedule():
+    by_efficiency = sorted(pump_ids, key=lambda pump: power_consumption(pump) / capacity(pump))
+    running = {time: [] for time in timeslots}
+    volumes = {}
+
+    volume = reservoir.Vinit
+    for time in timeslots:
+        volume -= water_demand(time)
+        for pump in by_efficiency:
+            if volume >= reservoir.Vmin or len(running[time]) == max_running_pumps:
+                break
+            if volume + capacity(pump) <= reservoir.Vmax:
+                running[time].append(pump)
+                volume += capacity(pump)
+        volumes[time] = volume
+
+    for pump in by_efficiency:
+        if any(pump in running[time] for time in timeslots):
+            continue
+        for time in sorted(timeslots, key=power_price):
+            later_times = [later for later in timeslots if later >= time]
+            if len(running[time]) < max_running_pumps and all(
+                    volumes[later] + capacity(pump) <= reservoir.Vmax for later in later_times):
+                running[time].append(pump)
+                for later in later_times:
+                    volumes[later] += capacity(pump)
+                break
+
+    return {
+        running_label(pump, time): int(pump in running[time])
+        for pump, time in pump_times
+    }
+
+greedy = greedy_schedule()
+greedy_cost = model.objective.energy(greedy)
+print(f"feasible: {model.check_feasible(greedy)}, cost: {greedy_cost:.2f}")
+# -
+
+# ### Hybrid solver
+#
+# The cells below submit the model to the Leap hybrid CQM solver, which needs a Leap account and API token. The notebook is committed with the outputs of every other cell, and without outputs for these.
+
 sampler = dw.LeapHybridCQMSampler()
 
 # %%time
 samples = sampler.sample_cqm(model, time_limit=120)
 samples.resolve()
 
-feasible = samples.filter(lambda d: d.is_feasible).to_pandas_dataframe(True)
+feasible = samples.filter(lambda d: d.is_feasible)
+
+# Only the best feasible sample is needed for the schedule, so it is selected before any conversion. `feasible.first` raises a `ValueError` when the solver found no feasible sample, so that case is reported explicitly.
+
+# +
+if not len(feasible):
+    raise RuntimeError("No feasible schedule found, try a longer time_limit")
+
+best = feasible.first
+# -
+
+best.energy
+
+# The solver's schedule is compared with the greedy baseline.
 
-feasible.energy.hist()
+print(f"solver: {best.energy:.2f}, greedy baseline: {greedy_cost:.2f}, saving: {greedy_cost - best.energy:.2f}")
 
-feasible.energy.min()
+{
+    time: [pump for pump in pump_ids if best.sample[running_label(pump, time)]]
+    for time in timeslots
+}
+
+# Converting every feasible sample to a DataFrame allocates a column per variable for each sample. Activate the cell below when the full sample set needs inspecting.
+
+# + active=""
+# feasible.to_pandas_dataframe(True).energy.hist()
+# -
+
+# Since the volume is a linear expression in the schedule, the model has only binary variables and can be converted to a BQM for direct QPU sampling.
+# The conversion turns every inequality into a penalty with slack variables: 168 variables become 857 with over 72,000 interactions, which is too dense to embed on current QPUs and needs a tuned Lagrange multiplier to come back feasible.
+# The cell below is kept inactive for experimenting with smaller horizons.
+
+# + active=""
+# bqm, invert = dimod.cqm_to_bqm(model, lagrange_multiplier=10)
+# qpu_samples = dw.EmbeddingComposite(dw.DWaveSampler()).sample(bqm, num_reads=1000)
+# qpu_feasible = [sample for sample in map(invert, qpu_samples.samples()) if model.check_feasible(sample)]
 
 # + [markdown] slideshow={"slide_type": "slide"}
 # ## Inspect model
@@ -463,8 +663,17 @@ lp_dump = dimod.lp.dumps(model)
 
 print(lp_dump)
 
-with open("reservoir.lp", "w") as f:
-    print(lp_dump, file=f)
+# The LP file is only rewritten when its contents change, so its modification time stays meaningful to tools that watch it.
+
+# +
+previous_dump = None
+if os.path.exists("reservoir.lp"):
+    with open("reservoir.lp") as f:
+        previous_dump = f.read()
+
+if previous_dump != lp_dump + "\n":
+    with open("reservoir.lp", "w") as f:
+        print(lp_dump, file=f)
 
 # + [markdown] slideshow={"slide_type": "slide"}
 # ## Formulation from paper